@@ -300,11 +300,14 @@ def helmholtz(u: OnGrid, medium: Medium, *, omega=1.0, params=None) -> OnGrid:
     return L + k, params
 
 
-def scale_source_helmholtz(source: Field, medium: Medium) -> Field:
-    if isinstance(medium.sound_speed, Field):
-        min_sos = functional(medium.sound_speed)(jnp.amin)
-    else:
-        min_sos = jnp.amin(medium.sound_speed)
+def scale_source_helmholtz(source: Field,
+                           medium: Medium,
+                           min_sos: object = None) -> Field:
+    if min_sos is None:
+        if isinstance(medium.sound_speed, Field):
+            min_sos = functional(medium.sound_speed)(jnp.amin)
+        else:
+            min_sos = jnp.amin(medium.sound_speed)
 
     source = source * 2 / (source.domain.dx[0] * min_sos)
     return source
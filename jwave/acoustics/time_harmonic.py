@@ -13,11 +13,13 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with j-Wave. If not, see <https://www.gnu.org/licenses/>.
 
-from math import factorial
-from typing import Union
+from functools import partial
+from math import ceil, factorial
+from typing import Callable, Union
 
 import jax
 from jax import numpy as jnp
+from jax.flatten_util import ravel_pytree
 from jax.lax import while_loop
 from jax.scipy.sparse.linalg import bicgstab, gmres
 from jaxdf import operator
@@ -456,10 +458,6 @@ def rayleigh_integral(
     Returns:
       complex64: Rayleigh integral at `r`
     """
-    # TODO: Override vmap on second dimension using Fourier implementation of the rayleigh integral
-    #       instead of the direct implementation. See Appendix B of
-    #       https://asa.scitation.org/doi/pdf/10.1121/1.4928396 for details.
-
     # Checks
     if pressure.ndim != 2:
         raise ValueError("Only 2D domains are supported.")
@@ -469,38 +467,480 @@ def rayleigh_integral(
     # Terms in the Rayleigh integral
     # See eq. A2 and A3 in https://asa.scitation.org/doi/10.1121/1.4928396
     k = 2 * jnp.pi * f0 / sound_speed
+    return _rayleigh_kernel(pressure, r, k), None
 
-    def exp_term(x, y, z):
-        """The exponential term of the Rayleigh integral
-        (first kind). This is basically the Green's function
-        of a dirac delta with Sommerfield radiation conditions."""
-        r = jnp.sqrt(x**2 + y**2 + z**2)
-        return jnp.exp(1j * k * r) / r
-
-    def direc_exp_term(x, y, z):
-        """Derivative of the exponential term in the Rayleigh integral,
-          along the z-axis (second kind). This is basically the Green's function
-          of a dipole oriented along the z-axis.
-        p = pressure.on_grid[...,0]
-        """
-        _, direc_derivative = jax.jvp(exp_term, (x, y, z), (0.0, 0.0, 1.0))
-        return direc_derivative
 
+def _rayleigh_kernel(pressure: FourierSeries, r, k):
+    r"""Direct evaluation of the Rayleigh integral at a single point `r`,
+    for the wavenumber `k`."""
     # Integral calculation as a finite sum
     area = pressure.domain.cell_volume
     plane_grid = pressure.domain.grid
+    px = plane_grid[..., 0]
+    py = plane_grid[..., 1]
+
+    # Displacement from the plane (z = 0) to r. The z component is
+    # the same scalar for all the points on the plane
+    dx = r[0] - px
+    dy = r[1] - py
+    dz = jnp.abs(r[2])
+    kernel = _dipole_green(dx, dy, dz, k)
+    return jnp.sum(kernel * pressure.on_grid[..., 0]) * area
+
+
+def _dipole_green(dx, dy, dz, k):
+    r"""Derivative along the z-axis of the Green's function $e^{ikr}/r$
+    (second kind). This is basically the Green's function of a dipole
+    oriented along the z-axis, written explicitly such that it can be
+    fused with the sum of the Rayleigh integral in a single
+    elementwise-reduction."""
+    r2 = dx * dx + dy * dy + dz * dz
+    r_norm = jnp.sqrt(r2)
+    phase = jnp.exp(1j * k * r_norm)
+    return dz * (1j * k * r_norm - 1.0) * phase / (r2 * r_norm)
+
+
+@operator
+def rayleigh_integral_plane(
+    pressure: FourierSeries,
+    *,
+    z,
+    f0,
+    sound_speed=1500.0,
+    params=None,
+) -> FourierSeries:
+    r"""Rayleigh integral for a `FourierSeries` field, evaluated on the
+    plane parallel to the pressure plane at distance `z`, on the same
+    grid points.
+
+    On a parallel plane, the Rayleigh integral is a 2D convolution with the
+    dipole Green's function, which is computed with zero-padded FFTs as in
+    Appendix B of [[Sapozhnikov et al.](https://asa.scitation.org/doi/pdf/10.1121/1.4928396)].
+    This costs $O(N \log N)$ operations instead of the $O(N^2)$ of evaluating
+    `rayleigh_integral` at every grid point. For target points that are not
+    on a parallel plane, use `rayleigh_integral_batched`.
+
+    Args:
+      pressure (FourierSeries): pressure field, corresponding to $u$ on the plane.
+      z (float): distance of the target plane from the pressure plane.
+      f0 (float): frequency of the source.
+      sound_speed (float): Value of the homogeneous sound speed where
+        the rayleigh integral is computed. Default is 1500 m/s.
+
+    Returns:
+      FourierSeries: Rayleigh integral on the target plane.
+    """
+    if pressure.ndim != 2:
+        raise ValueError("Only 2D domains are supported.")
+
+    k = 2 * jnp.pi * f0 / sound_speed
+    Nx, Ny = pressure.domain.N
+    area = pressure.domain.cell_volume
+
+    # Green's function for all the displacements between grid points,
+    # in FFT order on the zero-padded grid
+    def displacements(N, dx):
+        return jnp.fft.fftfreq(2 * N, 1 / (2 * N)) * dx
+
+    dx, dy = jnp.meshgrid(*map(displacements, pressure.domain.N,
+                               pressure.domain.dx),
+                          indexing="ij")
+    kernel = _dipole_green(dx, dy, jnp.abs(z), k)
+
+    # Linear convolution with zero padding
+    p = pressure.on_grid[..., 0]
+    p_hat = jnp.fft.fft2(p, s=(2 * Nx, 2 * Ny))
+    out = jnp.fft.ifft2(p_hat * jnp.fft.fft2(kernel))[:Nx, :Ny] * area
+    return FourierSeries(out, pressure.domain), None
+
+
+@partial(jax.jit, static_argnames=("batch_size", ))
+def rayleigh_integral_batched(
+    pressure: FourierSeries,
+    r_batch,
+    f0,
+    sound_speed=1500.0,
+    batch_size: Union[int, None] = None,
+):
+    r"""Rayleigh integral for a `FourierSeries` field, evaluated on a
+    batch of target points in a single compiled kernel.
+
+    This is equivalent to calling `rayleigh_integral` for each point, but
+    avoids tracing and launching a separate computation per point.
+
+    By default all the points are evaluated at once, which requires
+    storing `M * Nx * Ny` complex intermediates for `M` target points. For
+    large target grids, `batch_size` can be used to evaluate `batch_size`
+    points at a time with a sequential loop over the chunks, bounding the
+    memory to `batch_size * Nx * Ny` complex values. A reasonable choice is
+    the largest `batch_size` such that `batch_size * Nx * Ny * 8` bytes
+    is about half of the free device memory.
+
+    Args:
+      pressure (FourierSeries): pressure field, corresponding to $u$ on the plane.
+      r_batch (jnp.ndarray): target points, with respect to the origin of the
+        pressure plane. Must be an array of shape `(..., 3)`.
+      f0 (float): frequency of the source.
+      sound_speed (float): Value of the homogeneous sound speed where
+        the rayleigh integral is computed. Default is 1500 m/s.
+      batch_size (Union[int, None]): Number of target points evaluated
+        at once. If None, all points are evaluated at once. Defaults to None.
+
+    Returns:
+      jnp.ndarray: Rayleigh integral at each point of `r_batch`, with shape
+        `r_batch.shape[:-1]`.
+    """
+    if pressure.ndim != 2:
+        raise ValueError("Only 2D domains are supported.")
+
+    if r_batch.shape[-1] != 3:
+        raise ValueError("The target positions must be 3D vectors.")
+
+    k = 2 * jnp.pi * f0 / sound_speed
+    batch_shape = r_batch.shape[:-1]
+    r_batch = jnp.reshape(r_batch, (-1, 3))
+
+    kernel = jax.vmap(_rayleigh_kernel, in_axes=(None, 0, None))
+
+    if batch_size is None:
+        values = kernel(pressure, r_batch, k)
+    else:
+        # Pad to a whole number of chunks, and loop over them
+        num_points = r_batch.shape[0]
+        num_chunks = -(-num_points // batch_size)
+        padding = num_chunks * batch_size - num_points
+        r_chunks = jnp.pad(r_batch, ((0, padding), (0, 0)), mode="edge")
+        r_chunks = jnp.reshape(r_chunks, (num_chunks, batch_size, 3))
+        values = jax.lax.map(lambda r: kernel(pressure, r, k), r_chunks)
+        values = jnp.reshape(values, (-1, ))[:num_points]
+
+    return jnp.reshape(values, batch_shape)
+
+
+def _shifted_laplacian_preconditioner(
+    helm_func,
+    medium: Medium,
+    omega: object,
+    domain: Domain,
+    min_sos: object,
+    beta: float = 0.5,
+    smoothing_steps: int = 2,
+    damping: float = 0.5,
+):
+    r"""Builds an approximate inverse of the complex-shifted Helmholtz
+    operator
+
+    $$
+    \nabla^2 + (1 + i\beta)k^2
+    $$
+
+    to be used as a preconditioner for the Krylov solvers, following
+    [Erlangga et al, 2006](https://doi.org/10.1016/j.apnum.2005.04.039).
+
+    The shifted operator is inverted exactly in Fourier space for a
+    reference wavenumber $k_{ref} = \omega / \min(c)$. If the sound speed is
+    heterogeneous, the Fourier inverse is used as the coarse correction of
+    a two-level cycle, with `smoothing_steps` damped-Jacobi sweeps on the
+    heterogeneous shifted operator before and after it.
+
+    Args:
+      helm_func (Callable): The Helmholtz operator, as a function of the field.
+      medium (Medium): The acoustic medium.
+      omega (object): The angular frequency.
+      domain (Domain): The domain of the fields.
+      min_sos (object): The minimum sound speed of the medium.
+      beta (float): The complex shift. Defaults to 0.5.
+      smoothing_steps (int): Number of Jacobi sweeps before and after the
+        Fourier correction. Only used for heterogeneous sound speeds.
+        Defaults to 2.
+      damping (float): The damping factor of the Jacobi sweeps. Defaults to 0.5.
+
+    Returns:
+      Callable: The preconditioner, as a function of the residual field.
+    """
+    sound_speed = medium.sound_speed
+    k_ref_sq = (omega / min_sos)**2
+
+    freq_axis = [
+        jnp.fft.fftfreq(n, d) * 2 * jnp.pi for n, d in zip(domain.N, domain.dx)
+    ]
+    freq_grid = jnp.stack(jnp.meshgrid(*freq_axis, indexing="ij"), axis=-1)
+    p_sq = jnp.sum(freq_grid**2, -1)
+    g_fourier = 1.0 / (-p_sq + (1 + 1j * beta) * k_ref_sq)
+
+    def fourier_inverse(r):
+        u = jnp.fft.ifftn(g_fourier * jnp.fft.fftn(r.on_grid[..., 0]))
+        return r.replace_params(u)
+
+    if not isinstance(sound_speed, Field):
+        return fourier_inverse
+
+    # Heterogeneous medium: two-level cycle with Jacobi smoothing
+    k_sq = (omega / sound_speed.on_grid)**2
+    diagonal = -jnp.mean(p_sq) + (1 + 1j * beta) * k_sq
+
+    def shifted_helmholtz(u):
+        return helm_func(u) + u.replace_params(1j * beta * k_sq * u.params)
+
+    def jacobi(u, r):
+        res = r.params - shifted_helmholtz(u).params
+        return u.replace_params(u.params + damping * res / diagonal)
+
+    def precond_func(r):
+        u = r * 0
+        for _ in range(smoothing_steps):
+            u = jacobi(u, r)
+        res = r - shifted_helmholtz(u)
+        u = u + fourier_inverse(res)
+        for _ in range(smoothing_steps):
+            u = jacobi(u, r)
+        return u
+
+    return precond_func
+
+
+def _safe_divide(x, y):
+    r"""Returns `x / y`, or zero where `y` is zero."""
+    return jnp.where(y != 0, x / jnp.where(y != 0, y, 1.0), 0.0)
 
-    # Append z dimension of zeros to the last dimension
-    z_dim = jnp.zeros(plane_grid.shape[:-1] + (1, ))
-    plane_grid = jnp.concatenate((plane_grid, z_dim), axis=-1)
 
-    # Distance from r to the plane
-    R = jnp.abs(r - plane_grid)
+def _fgmres(A, b, x0, *, tol=1e-5, restart=20, maxiter=1000, M=None):
+    r"""Restarted Flexible GMRES [Saad, 1993](https://doi.org/10.1137/0914028).
 
-    # Weights of the Rayleigh integral
-    weights = jax.vmap(jax.vmap(direc_exp_term, in_axes=(0, 0, 0)),
-                       in_axes=(0, 0, 0))(R[..., 0], R[..., 1], R[..., 2])
-    return jnp.sum(weights * pressure.on_grid) * area, None
+    Differently from GMRES, the preconditioned vectors $z_j = M(v_j)$ are
+    stored alongside the Arnoldi basis $v_j$ and used to build the solution,
+    such that the preconditioner is allowed to change at every iteration
+    (for example, if it is itself an inexact iterative solver). This doubles
+    the memory required for the Krylov basis.
+
+    The solve is wrapped in `jax.lax.custom_linear_solve`, so derivatives
+    are computed by implicit differentiation rather than by unrolling.
+
+    Args:
+      A (Callable): The linear operator.
+      b (PyTree): The right-hand side.
+      x0 (PyTree): The initial guess.
+      tol (float): Relative tolerance on the residual norm.
+      restart (int): Size of the Krylov basis before restarting.
+      maxiter (int): Maximum number of restarts.
+      M (Callable, optional): The preconditioner. Defaults to the identity.
+
+    Returns:
+      PyTree: The approximate solution.
+    """
+    if M is None:
+        M = lambda x: x
+
+    def _solve(A, b):
+        b_flat, unravel = ravel_pytree(b)
+        x_flat, _ = ravel_pytree(x0)
+        num_unknowns = b_flat.shape[0]
+        dtype = b_flat.dtype
+        atol = tol * jnp.linalg.norm(b_flat)
+
+        def flat(f):
+            return lambda v: ravel_pytree(f(unravel(v)))[0]
+
+        A_flat, M_flat = flat(A), flat(M)
+
+        def arnoldi_step(j, carry):
+            V, Z, H = carry
+            z = M_flat(V[j])
+            w = A_flat(z)
+
+            # Gram-Schmidt with re-orthogonalization against v_0, ..., v_j
+            mask = jnp.arange(restart + 1) <= j
+            h = jnp.where(mask, V.conj() @ w, 0.0)
+            w = w - h @ V
+            h_corr = jnp.where(mask, V.conj() @ w, 0.0)
+            w = w - h_corr @ V
+            h = h + h_corr
+
+            w_norm = jnp.linalg.norm(w)
+            h = h.at[j + 1].set(w_norm)
+            V = V.at[j + 1].set(_safe_divide(w, w_norm))
+            return V, Z.at[j].set(z), H.at[:, j].set(h)
+
+        def restart_cycle(carry):
+            x, residual, residual_norm, k = carry
+            V = jnp.zeros((restart + 1, num_unknowns), dtype)
+            V = V.at[0].set(_safe_divide(residual, residual_norm))
+            Z = jnp.zeros((restart, num_unknowns), dtype)
+            H = jnp.zeros((restart + 1, restart), dtype)
+            V, Z, H = jax.lax.fori_loop(0, restart, arnoldi_step, (V, Z, H))
+
+            beta = jnp.zeros((restart + 1, ), dtype).at[0].set(residual_norm)
+            y = jnp.linalg.lstsq(H, beta)[0]
+            x = x + y @ Z
+            residual = b_flat - A_flat(x)
+            return x, residual, jnp.linalg.norm(residual), k + 1
+
+        def cond_fun(carry):
+            _, _, residual_norm, k = carry
+            return (k < maxiter) & (residual_norm > atol)
+
+        residual = b_flat - A_flat(x_flat)
+        carry = (x_flat, residual, jnp.linalg.norm(residual), 0)
+        x_flat = while_loop(cond_fun, restart_cycle, carry)[0]
+        return unravel(x_flat)
+
+    return jax.lax.custom_linear_solve(A,
+                                       b,
+                                       solve=_solve,
+                                       transpose_solve=_solve)
+
+
+def _bicgstab_fused(A, b, x0, *, tol=1e-5, maxiter=1000):
+    r"""BiCGSTAB with merged inner products.
+
+    This is the same iteration as `jax.scipy.sparse.linalg.bicgstab`, but
+    the inner products that only depend on the same vectors are computed
+    together as a single matrix-vector product with the stacked vectors:
+    $(t, s)$ with $(t, t)$, and $(\hat r, r)$ for the next iteration with
+    the residual norm $(r, r)$ used in the stopping criterion. This takes
+    three reductions over the grid per iteration instead of five.
+
+    The solve is wrapped in `jax.lax.custom_linear_solve`, so derivatives
+    are computed by implicit differentiation rather than by unrolling.
+
+    Args:
+      A (Callable): The linear operator.
+      b (PyTree): The right-hand side.
+      x0 (PyTree): The initial guess.
+      tol (float): Relative tolerance on the residual norm.
+      maxiter (int): Maximum number of iterations.
+
+    Returns:
+      PyTree: The approximate solution.
+    """
+
+    def _solve(A, b):
+        b_flat, unravel = ravel_pytree(b)
+        x_flat, _ = ravel_pytree(x0)
+        dtype = b_flat.dtype
+        atol_sq = (tol * jnp.linalg.norm(b_flat))**2
+
+        def A_flat(v):
+            return ravel_pytree(A(unravel(v)))[0]
+
+        def body_fun(carry):
+            x, r, r_hat, p, v, rho, alpha, omega, rho_new, _, k = carry
+            beta = _safe_divide(rho_new, rho) * _safe_divide(alpha, omega)
+            p = r + beta * (p - omega * v)
+            v = A_flat(p)
+            alpha = _safe_divide(rho_new, jnp.vdot(r_hat, v))
+            s = r - alpha * v
+            t = A_flat(s)
+            ts, tt = jnp.stack([s, t]) @ t.conj()
+            omega = _safe_divide(ts, tt)
+            x = x + alpha * p + omega * s
+            r = s - omega * t
+            rho_next, r_norm_sq = jnp.stack([r_hat, r]).conj() @ r
+            return (x, r, r_hat, p, v, rho_new, alpha, omega, rho_next,
+                    r_norm_sq.real, k + 1)
+
+        def cond_fun(carry):
+            r_norm_sq, k = carry[-2:]
+            return (k < maxiter) & (r_norm_sq > atol_sq)
+
+        r = b_flat - A_flat(x_flat)
+        rho_new = jnp.vdot(r, r)
+        one = jnp.ones((), dtype)
+        zeros = jnp.zeros_like(r)
+        carry = (x_flat, r, r, zeros, zeros, one, one, one, rho_new,
+                 rho_new.real, 0)
+        x_flat = while_loop(cond_fun, body_fun, carry)[0]
+        return unravel(x_flat)
+
+    return jax.lax.custom_linear_solve(A,
+                                       b,
+                                       solve=_solve,
+                                       transpose_solve=_solve)
+
+
+def _min_sound_speed(medium: Medium):
+    r"""Minimum sound speed of the medium."""
+    if isinstance(medium.sound_speed, Field):
+        return functional(medium.sound_speed)(jnp.amin)
+    else:
+        return jnp.amin(medium.sound_speed)
+
+
+def gmres_restart_from_wavelengths(medium: Medium, omega: float) -> int:
+    r"""Size of the Krylov basis for GMRES, chosen from the number of
+    wavelengths across the domain as $\lceil k_{max} L / \pi \rceil$, with
+    $k_{max} = \omega / \min(c)$ and $L$ the largest side of the domain. The
+    result is clipped to $[10, 100]$ to bound the memory used by the Krylov
+    vectors.
+
+    Larger domains in wavelengths typically need a larger basis for restarted
+    GMRES to converge. The value can be passed as the `restart` argument of
+    `helmholtz_solver`. Since the basis size is static, this function must be
+    called with a concrete sound speed and frequency, outside of
+    transformations such as `jax.jit` or `jax.grad`.
+
+    Args:
+      medium (Medium): The acoustic medium.
+      omega (float): The angular frequency.
+
+    Returns:
+      int: The size of the Krylov basis.
+    """
+    k_max = float(omega / _min_sound_speed(medium))
+    restart = ceil(k_max * max(medium.domain.size) / jnp.pi)
+    return min(max(restart, 10), 100)
+
+
+_HELMHOLTZ_PARAMS_CACHE = {}
+_HELMHOLTZ_PARAMS_CACHE_SIZE = 8
+
+
+def _helmholtz_params(source: Field, medium: Medium, omega: object):
+    r"""Returns `helmholtz.default_params(source, medium, omega=omega)`,
+    caching it across calls.
+
+    The parameters (the PML profiles and the differential operator stencils)
+    only depend on the discretization of the source and on the domain and
+    PML size of the medium, which are used as the cache key. In particular,
+    they don't depend on the frequency, such that a frequency sweep reuses
+    a single entry. If the parameters can't be evaluated at trace time, they
+    are recomputed at every call.
+
+    The cache holds the parameters on device until it is cleared with
+    `clear_helmholtz_params_cache`.
+    """
+    key = (
+        jax.tree_util.tree_structure(source),
+        medium.domain,
+        medium.pml_size,
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return helmholtz.default_params(source, medium, omega=omega)
+
+    if key not in _HELMHOLTZ_PARAMS_CACHE:
+        with jax.ensure_compile_time_eval():
+            params = helmholtz.default_params(source, medium, omega=omega)
+        if any(
+                isinstance(leaf, jax.core.Tracer)
+                for leaf in jax.tree_util.tree_leaves(params)):
+            return params
+
+        if len(_HELMHOLTZ_PARAMS_CACHE) >= _HELMHOLTZ_PARAMS_CACHE_SIZE:
+            _HELMHOLTZ_PARAMS_CACHE.pop(next(iter(_HELMHOLTZ_PARAMS_CACHE)))
+        _HELMHOLTZ_PARAMS_CACHE[key] = params
+
+    # Copy the containers, as the operators may add entries to the parameters
+    return jax.tree_util.tree_map(lambda x: x, _HELMHOLTZ_PARAMS_CACHE[key])
+
+
+def clear_helmholtz_params_cache():
+    r"""Clears the parameters of the `helmholtz` operator cached by
+    `helmholtz_solver` and `helmholtz_solver_verbose`, releasing the
+    device memory they use.
+    """
+    _HELMHOLTZ_PARAMS_CACHE.clear()
 
 
 @operator
@@ -512,6 +952,14 @@ def helmholtz_solver(
     guess: Union[OnGrid, None] = None,
     method: str = "gmres",
     checkpoint: bool = True,
+    checkpoint_policy: Union[Callable, None] = None,
+    preconditioner: Union[str, None] = None,
+    flexible: bool = False,
+    min_sos: object = None,
+    tol: float = 1e-3,
+    restart: int = 10,
+    maxiter: int = 1000,
+    solve_method: str = "batched",
     params=None,
     **kwargs,
 ):
@@ -522,96 +970,218 @@ def helmholtz_solver(
         omega (object): _description_
         source (OnGrid): _description_
         guess (Union[OnGrid, None], optional): _description_. Defaults to None.
-        method (str, optional): _description_. Defaults to 'gmres'.
+        method (str, optional): The Krylov solver, one of `'gmres'`,
+          `'bicgstab'` or `'bicgstab_fused'`. The latter is BiCGSTAB with
+          merged inner products, see `_bicgstab_fused`. Defaults to 'gmres'.
         checkpoint (bool, optional): _description_. Defaults to True.
+        checkpoint_policy (Union[Callable, None], optional): Policy passed to
+          `jax.checkpoint` to select which intermediates of the Helmholtz
+          operator are saved for the backward pass instead of being
+          recomputed, for example `jax.checkpoint_policies.everything_saveable`
+          to trade memory for speed when differentiating the solver.
+          If None, nothing is saved. Requires `checkpoint=True`.
+          Defaults to None.
+        preconditioner (Union[str, None], optional): If `'shifted_laplacian'`,
+          the Krylov solver is preconditioned with an approximate inverse of the
+          complex-shifted Helmholtz operator. See `_shifted_laplacian_preconditioner`.
+          Defaults to None.
+        flexible (bool, optional): If True, uses Flexible GMRES, which allows
+          the preconditioner to change between iterations at the cost of
+          storing twice as many Krylov vectors. Only valid for `method='gmres'`.
+          Defaults to False.
+        min_sos (object, optional): The minimum sound speed of the medium,
+          used to scale the source and by the preconditioner.
+          Can be given to avoid recomputing it when the solver is called
+          repeatedly on the same medium. Defaults to None, in which case it
+          is computed from `medium.sound_speed`.
+        tol (float, optional): Relative tolerance of the Krylov solver.
+          Defaults to 1e-3.
+        restart (int, optional): Size of the Krylov basis for GMRES. See
+          `gmres_restart_from_wavelengths` for a choice based on the
+          number of wavelengths in the domain. Defaults to 10.
+        maxiter (int, optional): Maximum number of iterations of the Krylov
+          solver. Defaults to 1000.
+        solve_method (str, optional): The `solve_method` of
+          `jax.scipy.sparse.linalg.gmres`. Defaults to 'batched'.
         params (_type_, optional): _description_. Defaults to None.
 
     Returns:
         _type_: _description_
     """
-    source = scale_source_helmholtz(source, medium)
+    if min_sos is None:
+        min_sos = _min_sound_speed(medium)
+
+    source = scale_source_helmholtz(source, medium, min_sos)
 
     if params is None:
-        params = helmholtz.default_params(source, medium, omega=omega)
+        params = _helmholtz_params(source, medium, omega)
 
     def helm_func(u):
         return helmholtz(u, medium, omega=omega, params=params)
 
     if checkpoint:
-        helm_func = jax.checkpoint(helm_func)
+        helm_func = jax.checkpoint(helm_func, policy=checkpoint_policy)
+    elif checkpoint_policy is not None:
+        raise ValueError("checkpoint_policy requires checkpoint=True")
 
     if guess is None:
         guess = source * 0
 
-    tol = kwargs["tol"] if "tol" in kwargs else 1e-3
-    restart = kwargs["restart"] if "restart" in kwargs else 10
-    maxiter = kwargs["maxiter"] if "maxiter" in kwargs else 1000
-    solve_method = kwargs[
-        "solve_method"] if "solve_method" in kwargs else "batched"
-    if method == "gmres":
-        out = gmres(
+    if preconditioner is None:
+        precond_func = None
+    elif preconditioner == "shifted_laplacian":
+        precond_func = _shifted_laplacian_preconditioner(
+            helm_func, medium, omega, source.domain, min_sos)
+    else:
+        raise ValueError(f"Unknown preconditioner {preconditioner}")
+
+    if flexible:
+        if method != "gmres":
+            raise ValueError(
+                "Flexible solvers are only available for method='gmres'")
+        out = _fgmres(
             helm_func,
             source,
             guess,
             tol=tol,
             restart=restart,
             maxiter=maxiter,
+            M=precond_func,
+        )
+        return -1j * omega * out, None
+
+    if precond_func is None:
+        linear_op, rhs, x0 = helm_func, source, guess
+    else:
+        # Right preconditioning: solves A M y = b - A x0 and sets x = x0 + M y,
+        # such that the stopping criterion is still on the true residual
+        def linear_op(y):
+            return helm_func(precond_func(y))
+
+        rhs = source - helm_func(guess)
+        x0 = rhs * 0
+
+    if method == "gmres":
+        out = gmres(
+            linear_op,
+            rhs,
+            x0,
+            tol=tol,
+            restart=restart,
+            maxiter=maxiter,
             solve_method=solve_method,
         )[0]
     elif method == "bicgstab":
-        out = bicgstab(helm_func, source, guess, tol=tol, maxiter=maxiter)[0]
+        out = bicgstab(linear_op, rhs, x0, tol=tol, maxiter=maxiter)[0]
+    elif method == "bicgstab_fused":
+        out = _bicgstab_fused(linear_op, rhs, x0, tol=tol, maxiter=maxiter)
+    else:
+        raise ValueError(f"Unknown method {method}")
+
+    if precond_func is not None:
+        out = guess + precond_func(out)
     return -1j * omega * out, None
 
 
+def _cnorm(x):
+    r"""Euclidean norm of a complex array, computed as a single conjugate
+    multiply-reduce."""
+    x = jnp.ravel(x)
+    return jnp.sqrt(jnp.vdot(x, x).real)
+
+
 def helmholtz_solver_verbose(
     medium: Medium,
     omega: float,
     source: OnGrid,
     guess: Union[OnGrid, None] = None,
     params=None,
+    print_every: int = 10,
+    tol: float = 1e-3,
+    maxiter: int = 1000,
     **kwargs,
 ):
+    r"""Solves the Helmholtz equation with restarted GMRES, printing
+    the residual magnitude during the solve.
 
-    src_magn = jnp.linalg.norm(source.on_grid)
-    source = source / src_magn
+    The restart cycles are run on device inside a `jax.lax.while_loop`,
+    and the solver only returns to Python every `print_every` cycles to
+    print the progress.
+
+    Args:
+        medium (Medium): The acoustic medium.
+        omega (float): The angular frequency.
+        source (OnGrid): The complex source field.
+        guess (Union[OnGrid, None], optional): Initial guess for the
+          solution, in the same units as the output. Defaults to None.
+        params (optional): Parameters of the `helmholtz` operator.
+          Defaults to None.
+        print_every (int, optional): Number of GMRES restart cycles between
+          progress prints. Defaults to 10.
+        tol (float, optional): Tolerance on the relative residual.
+          Defaults to 1e-3.
+        maxiter (int, optional): Maximum number of restart cycles.
+          Defaults to 1000.
+        **kwargs: Any other keyword argument of `helmholtz_solver`.
 
-    tol = kwargs["tol"] if "tol" in kwargs else 1e-3
-    residual_magnitude = jnp.linalg.norm(
-        helmholtz(source, medium, omega).params)
-    maxiter = kwargs["maxiter"] if "maxiter" in kwargs else 1000
+    Returns:
+        OnGrid: The complex pressure field.
+    """
+    src_magn = _cnorm(source.on_grid)
+    source = source / src_magn
+    min_sos = _min_sound_speed(medium)
+    scaled_source = scale_source_helmholtz(source, medium, min_sos)
+    scaled_source_magn = _cnorm(scaled_source.on_grid)
 
     if params is None:
-        params = helmholtz(source, medium, omega)._op_params
+        params = _helmholtz_params(scaled_source, medium, omega)
 
+    # Work with the field before the -1j*omega scaling of `helmholtz_solver`
     if guess is None:
         guess = source * 0
-
-    kwargs["maxiter"] = 1
-    kwargs["tol"] = 0.0
-    iterations = 0
-
-    if isinstance(medium.sound_speed, Field):
-        min_sos = functional(medium.sound_speed)(jnp.amin)
     else:
-        min_sos = jnp.amin(medium.sound_speed)
+        guess = guess / (-1j * omega * src_magn)
+
+    def residual_norm(medium, u, source):
+        residual = helmholtz(u, medium, omega=omega, params=params) - source
+        return _cnorm(residual.params) / scaled_source_magn
 
     @jax.jit
-    def solver(medium, guess, source):
-        guess = helmholtz_solver(medium,
-                                 omega,
-                                 source,
-                                 guess,
-                                 "gmres",
-                                 **kwargs,
-                                 params=params)
-        residual = helmholtz(guess, medium, omega, params=params) - source
-        residual_magnitude = jnp.linalg.norm(residual.params)
-        return guess, residual_magnitude
+    def solver(medium, guess, source, iterations, last_iteration):
+        scaled_source = scale_source_helmholtz(source, medium, min_sos)
+
+        def cond_fun(carry):
+            _, residual_magnitude, iterations = carry
+            return (residual_magnitude > tol) & (iterations < last_iteration)
+
+        # Each call to the solver runs a single restart cycle
+        def body_fun(carry):
+            guess, _, iterations = carry
+            guess = helmholtz_solver(medium,
+                                     omega,
+                                     source,
+                                     guess=guess,
+                                     method="gmres",
+                                     min_sos=min_sos,
+                                     tol=0.0,
+                                     maxiter=1,
+                                     params=params,
+                                     **kwargs) / (-1j * omega)
+            residual_magnitude = residual_norm(medium, guess, scaled_source)
+            return guess, residual_magnitude, iterations + 1
+
+        residual_magnitude = residual_norm(medium, guess, scaled_source)
+        carry = (guess, residual_magnitude, iterations)
+        return while_loop(cond_fun, body_fun, carry)
 
+    iterations = 0
+    residual_magnitude = jnp.inf
     while residual_magnitude > tol and iterations < maxiter:
-        guess, residual_magnitude = solver(medium, guess, source)
-
-        iterations += 1
+        last_iteration = min(iterations + print_every, maxiter)
+        guess, residual_magnitude, iterations = solver(medium, guess, source,
+                                                       iterations,
+                                                       last_iteration)
+        iterations = int(iterations)
 
         # Print iteration info
         print(
@@ -619,4 +1189,4 @@ def helmholtz_solver_verbose(
             flush=True,
         )
 
-    return -1j * omega * guess * src_magn * 2 / (source.domain.dx[0] * min_sos)
+    return -1j * omega * guess * src_magn
@@ -13,9 +13,11 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with j-Wave. If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Callable
+from functools import lru_cache, partial
+from math import ceil
+from typing import Callable, Tuple, Union
 
-from jax import Array, eval_shape
+from jax import Array, ensure_compile_time_eval, jit
 from jax import numpy as jnp
 from jax import vmap
 
@@ -147,9 +149,30 @@ def apply_ramp(signal: Array,
         raise ValueError(f"Signal must be 1D, got {signal.ndim}D")
 
     t = jnp.arange(signal.shape[0]) * dt
-    period = 1 / center_freq
-    ramp_length = warmup_cycles * period
-    return signal * jnp.where(t < ramp_length, (t / ramp_length), 1.0)
+
+    # There is no ramp for zero warmup cycles: avoid dividing by zero and
+    # offset the ramp above 1, so that the envelope is clipped to 1
+    has_ramp = warmup_cycles > 0
+    ramp_slope = center_freq / jnp.where(has_ramp, warmup_cycles, 1.0)
+    ramp = jnp.minimum(t * ramp_slope + (1.0 - has_ramp), 1.0)
+    return signal * ramp
+
+
+@partial(jit,
+         donate_argnums=(0, ),
+         static_argnames=("dt", "center_freq", "warmup_cycles"))
+def apply_ramp_donated(signal: Array,
+                       dt: float,
+                       center_freq: float,
+                       warmup_cycles: float = 3) -> Array:
+    r"""Same as `apply_ramp`, but the buffer of `signal` is donated to
+    the output, such that no new buffer is allocated for it. The `signal`
+    array can't be used after calling this function.
+
+    The arguments other than `signal` are static: the function is compiled
+    again for each new value.
+    """
+    return apply_ramp(signal, dt, center_freq, warmup_cycles)
 
 
 def blackman(N: int) -> Array:
@@ -186,49 +209,104 @@ def gaussian_window(signal: Array, time: Array, mu: float,
     return signal * jnp.exp(-((time - mu)**2) / sigma**2)
 
 
-def smoothing_filter(sample_input: jnp.ndarray) -> Callable:
-    r"""Returns a smoothing filter based on the blackman window, which
-    works on a signal similar to the one provided as input. The filter
-    is amenable to jax transformations.
+@partial(jit, donate_argnums=(0, ))
+def gaussian_window_donated(signal: Array, time: Array, mu: float,
+                            sigma: float) -> Array:
+    r"""Same as `gaussian_window`, but the buffer of `signal` is donated to
+    the output, such that no new buffer is allocated for it. The `signal`
+    array can't be used after calling this function.
+    """
+    return gaussian_window(signal, time, mu, sigma)
+
+
+@lru_cache(maxsize=8)
+def _blackman_filter(shape: Tuple[int, ...],
+                     exponent: float = 1.0,
+                     real_input: bool = False) -> Array:
+    r"""Returns the spectrum of the smoothing filter for a signal with the
+    given shape, built as the product of blackman windows along each axis
+    and raised to `exponent`.
+
+    For real signals, only the Hermitian-symmetric part of the filter
+    contributes to the real output: this is what is returned, cut along
+    the last axis to the size of the `rfftn` spectrum.
 
     Args:
-        sample_input (jnp.ndarray): Example signal
+        shape (Tuple[int, ...]): Shape of the signal
+        exponent (float, optional): Exponent of the filter. Defaults to 1.0.
+        real_input (bool, optional): If True, returns the filter for the
+            `rfftn` spectrum. Defaults to False.
 
     Returns:
-        Callable: Smoothing filter
+        jnp.ndarray: The filter
     """
-    # Constructs the filter
-    dimensions = sample_input.shape
-    axis = [blackman(x) for x in dimensions]
-    if len(dimensions) == 1:
-        filter_kernel = jnp.fft.fftshift(axis[0])
+    with ensure_compile_time_eval():
+        filter_kernel = jnp.ones(shape)
+        for axis, N in enumerate(shape):
+            window_shape = [1] * len(shape)
+            window_shape[axis] = N
+            window = jnp.fft.fftshift(blackman(N))
+            filter_kernel = filter_kernel * jnp.reshape(window, window_shape)
+        filter_kernel = filter_kernel**exponent
+
+        if real_input:
+            axes = tuple(range(len(shape)))
+            mirrored = jnp.roll(jnp.flip(filter_kernel, axes), 1, axes)
+            filter_kernel = 0.5 * (filter_kernel + mirrored)
+            filter_kernel = filter_kernel[..., :shape[-1] // 2 + 1]
+
+    return filter_kernel
+
+
+def _apply_filter(filter_kernel: Array, x: Array, real_input: bool) -> Array:
+    if real_input:
+        return jnp.fft.irfftn(filter_kernel * jnp.fft.rfftn(x), s=x.shape)
     else:
-        # TODO: Find a more elegant way of constructing the filter
-        if len(axis) == 1:
-            filter_kernel = axis[0]
-        elif len(axis) == 2:
-            filter_kernel = jnp.fft.fftshift(jnp.outer(*axis))
-        elif len(axis) == 3:
-            filter_kernel_2d = jnp.outer(*axis[1:])
-            third_component = jnp.expand_dims(jnp.expand_dims(axis[0], 1), 2)
-            filter_kernel = third_component * filter_kernel_2d
+        return jnp.fft.ifftn(filter_kernel * jnp.fft.fftn(x)).real
 
-    # Different filtering functions for real and complex data
-    if sample_input.dtype != jnp.complex64 and sample_input.dtype != jnp.complex128:
-        Fx = eval_shape(jnp.fft.rfft, sample_input)
-        filter_kernel = filter_kernel[..., :Fx.shape[-1]]
 
-        def smooth_fun(x):
-            return jnp.fft.irfftn(filter_kernel * jnp.fft.rfftn(x)).real
+@lru_cache(maxsize=8)
+def _smoothing_kernel(shape: Tuple[int, ...],
+                      exponent: float = 1.0,
+                      real_input: bool = False) -> Callable:
+    r"""Returns a compiled smoothing function for signals with the given
+    shape, where the filter is a compile-time constant that XLA can fuse
+    with the transforms.
 
-    else:
+    Args:
+        shape (Tuple[int, ...]): Shape of the signal
+        exponent (float, optional): Exponent of the filter. Defaults to 1.0.
+        real_input (bool, optional): If True, the function works on real
+            signals. Defaults to False.
 
-        def smooth_fun(x):
-            return jnp.fft.ifftn(filter_kernel * jnp.fft.fftn(x)).real
+    Returns:
+        Callable: Smoothing function
+    """
+    filter_kernel = _blackman_filter(shape, exponent, real_input)
+
+    @jit
+    def smooth_fun(x):
+        return _apply_filter(filter_kernel, x, real_input)
 
     return smooth_fun
 
 
+def smoothing_filter(sample_input: jnp.ndarray) -> Callable:
+    r"""Returns a smoothing filter based on the blackman window, which
+    works on a signal similar to the one provided as input. The filter
+    is amenable to jax transformations.
+
+    Args:
+        sample_input (jnp.ndarray): Example signal
+
+    Returns:
+        Callable: Smoothing filter
+    """
+    # Different filtering functions for real and complex data
+    return _smoothing_kernel(sample_input.shape,
+                             real_input=not jnp.iscomplexobj(sample_input))
+
+
 def smooth(
     x: Array,
     exponent: float = 1.0,
@@ -242,23 +320,33 @@ def smooth(
     Returns:
         jnp.ndarray: [description]
     """
-    dimensions = x.shape
-    axis = [blackman(x) for x in dimensions]
-    if len(dimensions) == 1:
-        filter_kernel = jnp.fft.fftshift(axis[0])
-    else:
-        # TODO: Find a more elegant way of constructing the filter
-        if len(axis) == 1:
-            filter_kernel = jnp.fft.fftshift(axis[0])
-        elif len(axis) == 2:
-            filter_kernel = jnp.fft.fftshift(jnp.outer(*axis))
-        elif len(axis) == 3:
-            filter_kernel_2d = jnp.outer(*axis[1:])
-            third_component = jnp.expand_dims(jnp.expand_dims(axis[0], 1), 2)
-            filter_kernel = jnp.fft.fftshift(third_component *
-                                             filter_kernel_2d)
-    filter_kernel = filter_kernel**exponent
-    return jnp.fft.ifftn(filter_kernel * jnp.fft.fftn(x)).real
+    real_input = not jnp.iscomplexobj(x)
+    if isinstance(exponent, (int, float)):
+        return _smoothing_kernel(x.shape, exponent, real_input)(x)
+
+    # Traced exponents can't be used as cache keys
+    filter_kernel = _blackman_filter.__wrapped__(x.shape, exponent, real_input)
+    return _apply_filter(filter_kernel, x, real_input)
+
+
+@partial(jit, donate_argnums=(0, ), static_argnames=("exponent", ))
+def smooth_donated(
+    x: Array,
+    exponent: float = 1.0,
+) -> Array:
+    """Same as `smooth`, but the buffer of `x` is donated to the output,
+    such that no new buffer is allocated for it. The `x` array can't be
+    used after calling this function.
+
+    Only real signals are supported, since the output of `smooth` is
+    always real and can't reuse the buffer of a complex signal. When called
+    inside another transformation such as `jax.jit`, the donation has no
+    effect, as XLA already reuses the buffers there.
+    """
+    if jnp.iscomplexobj(x):
+        raise ValueError(
+            "smooth_donated only supports real signals, use smooth instead")
+    return smooth(x, exponent)
 
 
 def _dist_from_ends(N: int) -> Array:
@@ -267,29 +355,48 @@ def _dist_from_ends(N: int) -> Array:
          jnp.flip(jnp.arange(0, N - N // 2))])
 
 
-def tone_burst(sample_freq: float, signal_freq: float,
-               num_cycles: float) -> Array:
+@partial(jit, static_argnames=("num_samples", ))
+def _tone_burst(sample_freq: float, signal_freq: float,
+                num_samples: int) -> Array:
+    t = jnp.arange(num_samples) / sample_freq
+
+    # Gaussian window
+    x_lim = 3
+    window_x = jnp.linspace(-x_lim, x_lim, num_samples)
+    return jnp.sin(2 * jnp.pi * signal_freq * t) * jnp.exp(-0.5 * window_x**2)
+
+
+def tone_burst(sample_freq: float,
+               signal_freq: float,
+               num_cycles: Union[float, None] = None,
+               num_samples: Union[int, None] = None) -> Array:
     r"""Returns a tone burst
 
+    The length of the signal is given either by `num_cycles` or by
+    `num_samples`. The signal is compiled once for each number of samples,
+    and can be reused for different frequencies. If `num_cycles` is used,
+    `sample_freq`, `signal_freq` and `num_cycles` must be known at trace
+    time to compute the number of samples.
+
     Args:
         sample_freq (float): Sampling frequency
         signal_freq (float): Signal frequency
-        num_cycles (float): Number of cycles
+        num_cycles (Union[float, None], optional): Number of cycles.
+            Defaults to None.
+        num_samples (Union[int, None], optional): Number of samples of the
+            signal. Defaults to None.
 
     Returns:
         jnp.ndarray: The tone burst signal
     """
+    if (num_cycles is None) == (num_samples is None):
+        raise ValueError(
+            "Exactly one of num_cycles and num_samples must be given")
 
-    def gaussian(x, magnitude, mean, variance):
-        return magnitude * jnp.exp(-((x - mean)**2) / (2 * variance))
-
-    dt = 1 / sample_freq
-    tone_length = num_cycles / signal_freq
-    tone_t = jnp.arange(0, tone_length + dt, dt)
-    tone_burst = jnp.sin(2 * jnp.pi * signal_freq * tone_t)
+    if num_samples is None:
+        # Same length as jnp.arange(0, tone_length + dt, dt)
+        dt = 1 / float(sample_freq)
+        tone_length = float(num_cycles) / float(signal_freq)
+        num_samples = ceil((tone_length + dt) / dt)
 
-    # Gaussian window
-    x_lim = 3
-    window_x = jnp.linspace(-x_lim, x_lim, tone_burst.shape[0])
-    window = gaussian(window_x, 1, 0, 1)
-    return tone_burst * window
+    return _tone_burst(sample_freq, signal_freq, num_samples)
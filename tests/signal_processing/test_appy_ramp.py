@@ -15,8 +15,9 @@
 
 import numpy as np
 import pytest
+from jax import numpy as jnp
 
-from jwave.signal_processing import apply_ramp
+from jwave.signal_processing import apply_ramp, apply_ramp_donated
 
 
 def test_apply_ramp_with_zero_signal():
@@ -78,3 +79,22 @@ def test_apply_ramp_with_high_warmup_cycles():
     result = apply_ramp(signal, dt, center_freq, warmup_cycles)
     assert np.allclose(result[:101], np.linspace(0, 1, 101))
     assert np.all(result[101:] == 1)
+
+
+def test_apply_ramp_donated():
+    signal = np.ones(100, dtype=np.float32)
+    dt = 0.01
+    center_freq = 10.0
+    expected = apply_ramp(signal, dt, center_freq)
+    signal_device = jnp.asarray(signal)
+    result = apply_ramp_donated(signal_device, dt, center_freq)
+    assert np.allclose(result, expected)
+    assert signal_device.is_deleted()
+
+
+def test_apply_ramp_with_zero_warmup_cycles():
+    signal = np.ones(100)
+    dt = 0.01
+    center_freq = 10.0
+    assert np.all(apply_ramp(signal, dt, center_freq, 0.0) == 1)
+    assert np.all(apply_ramp(signal, dt, center_freq, jnp.asarray(0.0)) == 1)
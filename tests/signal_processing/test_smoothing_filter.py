@@ -1,6 +1,9 @@
 import numpy as np
+import pytest
+from jax import numpy as jnp
 
-from jwave.signal_processing import blackman, smoothing_filter
+from jwave.signal_processing import (_blackman_filter, blackman, smooth,
+                                     smooth_donated, smoothing_filter)
 
 
 def test_smoothing_filter_with_1d_input():
@@ -41,3 +44,36 @@ def test_smoothing_filter_with_zero_input():
 def test_blackman_function():
     result = blackman(100)
     assert len(result) == 100
+
+
+def test_smoothing_filter_with_odd_input():
+    sample_input = np.random.rand(9, 7)
+    smooth_fun = smoothing_filter(sample_input)
+    result = smooth_fun(sample_input)
+    assert result.shape == sample_input.shape
+
+
+def test_smooth_real_matches_complex_filtering():
+    x = np.random.rand(9, 8, 7)
+    for exponent in [1.0, 2.0]:
+        filter_kernel = _blackman_filter(x.shape, exponent)
+        expected = np.fft.ifftn(filter_kernel * np.fft.fftn(x)).real
+        assert np.allclose(smooth(x, exponent), expected, atol=1e-5)
+
+
+def test_smooth_donated():
+    x = np.random.rand(16, 15).astype(np.float32)
+    expected = smooth(x, 2.0)
+    x_device = jnp.asarray(x)
+    assert np.allclose(smooth_donated(x_device, 2.0), expected)
+    assert x_device.is_deleted()
+
+    with pytest.raises(ValueError):
+        smooth_donated(jnp.asarray(x + 1j * x))
+
+
+def test_smoothing_filter_does_not_print(capsys):
+    sample_input = np.random.rand(16, 15)
+    smooth_fun = smoothing_filter(sample_input)
+    smooth_fun(sample_input)
+    assert capsys.readouterr().out == ""
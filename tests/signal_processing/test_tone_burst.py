@@ -13,9 +13,32 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with j-Wave. If not, see <https://www.gnu.org/licenses/>.
 
+import numpy as np
+import pytest
+from jax import numpy as jnp
+from jax import vmap
+
 from jwave.signal_processing import tone_burst
 
 
 def test_tone_burst_with_valid_inputs():
     result = tone_burst(1000.0, 100.0, 10.0)
     assert len(result) > 0
+
+
+def test_tone_burst_with_num_samples():
+    result = tone_burst(1000.0, 100.0, 10.0)
+    fixed_length = tone_burst(1000.0, 100.0, num_samples=len(result))
+    assert np.allclose(result, fixed_length)
+
+    # Frequencies can be traced when the number of samples is given
+    signals = vmap(lambda f: tone_burst(1000.0, f, num_samples=64))(
+        jnp.asarray([100.0, 200.0]))
+    assert signals.shape == (2, 64)
+
+
+def test_tone_burst_requires_one_length():
+    with pytest.raises(ValueError):
+        tone_burst(1000.0, 100.0)
+    with pytest.raises(ValueError):
+        tone_burst(1000.0, 100.0, 10.0, 64)
@@ -13,13 +13,42 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with j-Wave. If not, see <https://www.gnu.org/licenses/>.
 
+import jax
+import pytest
 from jax import numpy as jnp
 
-from jwave.acoustics.operators import helmholtz
-from jwave.acoustics.time_harmonic import helmholtz_solver
+from jwave.acoustics.operators import helmholtz, scale_source_helmholtz
+from jwave.acoustics.time_harmonic import (_HELMHOLTZ_PARAMS_CACHE,
+                                            _helmholtz_params,
+                                            clear_helmholtz_params_cache,
+                                            gmres_restart_from_wavelengths,
+                                            helmholtz_solver,
+                                            helmholtz_solver_verbose)
 from jwave.geometry import Domain, FourierSeries, Medium
 
 
+@pytest.fixture
+def domain():
+    return Domain((64, 64), (1e-4, 1e-4))
+
+
+@pytest.fixture
+def omega():
+    return 2 * jnp.pi * 1.5e6
+
+
+@pytest.fixture
+def src_field(domain):
+    src_field = jnp.zeros(domain.N).astype(jnp.complex64)
+    src_field = src_field.at[32, 16].set(1.0)
+    return FourierSeries(src_field, domain)
+
+
+@pytest.fixture
+def medium(domain):
+    return Medium(domain, sound_speed=1500.0, pml_size=10)
+
+
 def test_if_homog_helmholtz_runs():
     N = (128, 128)
     domain = Domain(N, (1.0, 1.0))
@@ -41,6 +70,118 @@ def test_if_homog_helmholtz_runs():
     )
 
 
+def test_shifted_laplacian_preconditioner_reduces_residual(
+        domain, omega, src_field):
+    sos = jnp.ones(domain.N) * 1500.0
+    sos = sos.at[20:40, 30:50].set(1800.0)
+    medium = Medium(domain, sound_speed=FourierSeries(sos, domain), pml_size=10)
+
+    def relative_residual(preconditioner):
+        field = helmholtz_solver(medium,
+                                 omega,
+                                 src_field,
+                                 tol=1e-6,
+                                 restart=10,
+                                 maxiter=3,
+                                 preconditioner=preconditioner)
+        source = scale_source_helmholtz(src_field, medium)
+        residual = helmholtz(field / (-1j * omega), medium,
+                             omega=omega) - source
+        return jnp.linalg.norm(residual.on_grid) / jnp.linalg.norm(
+            source.on_grid)
+
+    assert relative_residual("shifted_laplacian") < relative_residual(None)
+
+
+def test_flexible_gmres_matches_gmres(medium, omega, src_field):
+    field = helmholtz_solver(medium, omega, src_field, tol=1e-5)
+    for preconditioner in [None, "shifted_laplacian"]:
+        flexible_field = helmholtz_solver(medium,
+                                          omega,
+                                          src_field,
+                                          tol=1e-5,
+                                          flexible=True,
+                                          preconditioner=preconditioner)
+        error = jnp.linalg.norm((flexible_field - field).on_grid)
+        assert error / jnp.linalg.norm(field.on_grid) < 1e-3
+
+
+def test_bicgstab_fused_matches_gmres(medium, omega, src_field):
+    field = helmholtz_solver(medium, omega, src_field, tol=1e-5)
+    for preconditioner in [None, "shifted_laplacian"]:
+        fused_field = helmholtz_solver(medium,
+                                       omega,
+                                       src_field,
+                                       tol=1e-5,
+                                       method="bicgstab_fused",
+                                       preconditioner=preconditioner)
+        error = jnp.linalg.norm((fused_field - field).on_grid)
+        assert error / jnp.linalg.norm(field.on_grid) < 1e-3
+
+
+def test_gmres_restart_from_wavelengths(domain, omega):
+    # 6.4 mm domain, 1 mm wavelength: ceil(2 * 6.4) = 13
+    medium = Medium(domain, sound_speed=1500.0)
+    assert gmres_restart_from_wavelengths(medium, omega) == 13
+
+    # Uses the minimum sound speed, and is clipped to [10, 100]
+    sos = jnp.ones(domain.N) * 1500.0
+    sos = sos.at[0, 0].set(750.0)
+    medium = Medium(domain, sound_speed=FourierSeries(sos, domain))
+    assert gmres_restart_from_wavelengths(medium, omega) == 26
+    assert gmres_restart_from_wavelengths(medium, 2 * jnp.pi * 1e3) == 10
+    assert gmres_restart_from_wavelengths(medium, 2 * jnp.pi * 1e8) == 100
+
+
+def test_checkpoint_policy_gradient(domain, omega, src_field):
+    def loss(sound_speed, policy):
+        medium = Medium(domain, sound_speed=sound_speed, pml_size=10)
+        field = helmholtz_solver(medium,
+                                 omega,
+                                 src_field,
+                                 tol=1e-5,
+                                 restart=10,
+                                 maxiter=5,
+                                 checkpoint_policy=policy)
+        return jnp.sum(jnp.abs(field.on_grid)**2)
+
+    grad = jax.grad(loss)(1500.0, None)
+    grad_saved = jax.grad(loss)(1500.0,
+                                jax.checkpoint_policies.everything_saveable)
+    assert jnp.allclose(grad, grad_saved, rtol=1e-3)
+
+
+def test_checkpoint_policy_requires_checkpoint(medium, omega, src_field):
+    with pytest.raises(ValueError):
+        helmholtz_solver(medium,
+                         omega,
+                         src_field,
+                         checkpoint=False,
+                         checkpoint_policy=jax.checkpoint_policies.
+                         everything_saveable)
+
+
+def test_verbose_solver_matches_solver(capsys, medium, omega, src_field):
+    field = helmholtz_solver(medium,
+                             omega,
+                             src_field,
+                             tol=1e-5,
+                             preconditioner="shifted_laplacian")
+    verbose_field = helmholtz_solver_verbose(
+        medium,
+        omega,
+        src_field,
+        tol=1e-5,
+        maxiter=20,
+        print_every=2,
+        preconditioner="shifted_laplacian",
+    )
+
+    assert "residual magnitude" in capsys.readouterr().out
+    error = jnp.linalg.norm((verbose_field - field).on_grid)
+    assert error / jnp.linalg.norm(field.on_grid) < 1e-3
+
+
 def test_default_params():
     N = (128, 128)
     domain = Domain(N, (1.0, 1.0))
@@ -58,5 +199,41 @@ def test_default_params():
     assert 'fft_u' in default_params.keys()
 
 
+def test_helmholtz_params_are_cached():
+    N = (32, 32)
+    domain = Domain(N, (1.0, 1.0))
+    field = FourierSeries(jnp.zeros(N).astype(jnp.complex64), domain)
+    medium = Medium(domain, sound_speed=1.0, pml_size=5)
+
+    params = _helmholtz_params(field, medium, 1.0)
+    cached_params = _helmholtz_params(field * 2, medium, 1.0)
+    reference = helmholtz.default_params(field, medium, omega=1.0)
+
+    # Same arrays, but different containers
+    assert cached_params is not params
+    for leaf, cached_leaf, ref_leaf in zip(
+            jax.tree_util.tree_leaves(params),
+            jax.tree_util.tree_leaves(cached_params),
+            jax.tree_util.tree_leaves(reference),
+    ):
+        assert leaf is cached_leaf
+        assert jnp.allclose(leaf, ref_leaf)
+
+
+def test_helmholtz_params_cache_is_shared_across_frequencies():
+    N = (32, 32)
+    domain = Domain(N, (1.0, 1.0))
+    field = FourierSeries(jnp.zeros(N).astype(jnp.complex64), domain)
+    medium = Medium(domain, sound_speed=1.0, pml_size=5)
+
+    clear_helmholtz_params_cache()
+    for omega in [1.0, 1.1, 1.2]:
+        _helmholtz_params(field, medium, omega)
+    assert len(_HELMHOLTZ_PARAMS_CACHE) == 1
+
+    clear_helmholtz_params_cache()
+    assert len(_HELMHOLTZ_PARAMS_CACHE) == 0
+
+
 if __name__ == "__main__":
     test_if_homog_helmholtz_runs()
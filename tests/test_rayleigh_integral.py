@@ -0,0 +1,106 @@
+# This file is part of j-Wave.
+#
+# j-Wave is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# j-Wave is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with j-Wave. If not, see <https://www.gnu.org/licenses/>.
+
+import jax
+from jax import numpy as jnp
+
+from jwave.acoustics.time_harmonic import (rayleigh_integral,
+                                            rayleigh_integral_batched,
+                                            rayleigh_integral_plane)
+from jwave.geometry import Domain, FourierSeries
+
+
+def _reference_rayleigh(pressure, r, f0, sound_speed):
+    k = 2 * jnp.pi * f0 / sound_speed
+
+    def green(z, x, y):
+        dist = jnp.sqrt(x**2 + y**2 + z**2)
+        return jnp.exp(1j * k * dist) / dist
+
+    def dgreen_dz(z, x, y):
+        real = jax.grad(lambda z: green(z, x, y).real)(z)
+        imag = jax.grad(lambda z: green(z, x, y).imag)(z)
+        return real + 1j * imag
+
+    grid = pressure.domain.grid.reshape(-1, 2)
+    x, y = r[0] - grid[:, 0], r[1] - grid[:, 1]
+    weights = jax.vmap(dgreen_dz, (None, 0, 0))(r[2], x, y)
+    p = pressure.on_grid[..., 0].reshape(-1)
+    return jnp.sum(weights * p) * pressure.domain.cell_volume
+
+
+def test_rayleigh_integral_matches_reference():
+    N = (16, 12)
+    domain = Domain(N, (1e-4, 1e-4))
+    key = jax.random.PRNGKey(0)
+    p = jax.random.normal(key, N) + 1j * jax.random.normal(key, N)[::-1]
+    pressure = FourierSeries(p, domain)
+
+    r = jnp.array([2e-4, -1e-4, 3e-3])
+    f0 = 1e6
+    value = rayleigh_integral(pressure, r=r, f0=f0, sound_speed=1500.0)
+    reference = _reference_rayleigh(pressure, r, f0, 1500.0)
+
+    assert jnp.allclose(value, reference, rtol=1e-4)
+
+
+def test_rayleigh_integral_batched():
+    N = (16, 12)
+    domain = Domain(N, (1e-4, 1e-4))
+    key = jax.random.PRNGKey(0)
+    pressure = FourierSeries(jax.random.normal(key, N) + 0j, domain)
+
+    r_batch = jnp.stack(jnp.meshgrid(jnp.linspace(-5e-4, 5e-4, 4),
+                                     jnp.linspace(-5e-4, 5e-4, 3),
+                                     jnp.asarray([2e-3]),
+                                     indexing="ij"),
+                        axis=-1)[..., 0, :]
+    values = rayleigh_integral_batched(pressure, r_batch, 1e6, 1500.0)
+    assert values.shape == (4, 3)
+
+    for idx in [(0, 0), (2, 1), (3, 2)]:
+        reference = rayleigh_integral(pressure,
+                                      r=r_batch[idx],
+                                      f0=1e6,
+                                      sound_speed=1500.0)
+        assert jnp.allclose(values[idx], reference, rtol=1e-5)
+
+    # Chunked evaluation, with a batch size that doesn't divide the points
+    chunked = rayleigh_integral_batched(pressure,
+                                        r_batch,
+                                        1e6,
+                                        1500.0,
+                                        batch_size=5)
+    assert jnp.allclose(chunked, values, rtol=1e-5)
+
+
+def test_rayleigh_integral_plane():
+    N = (16, 11)
+    domain = Domain(N, (1e-4, 1e-4))
+    key = jax.random.PRNGKey(0)
+    p = jax.random.normal(key, N) + 1j * jax.random.normal(key, N)[::-1]
+    pressure = FourierSeries(p, domain)
+
+    z = 1e-3
+    plane = rayleigh_integral_plane(pressure, z=z, f0=1e6, sound_speed=1500.0)
+    assert plane.domain == domain
+
+    grid = domain.grid
+    r_batch = jnp.concatenate([grid, jnp.full(N + (1, ), z)], axis=-1)
+    direct = rayleigh_integral_batched(pressure, r_batch, 1e6, 1500.0)
+    assert jnp.allclose(plane.on_grid[..., 0],
+                        direct,
+                        rtol=1e-4,
+                        atol=1e-4 * jnp.amax(jnp.abs(direct)))